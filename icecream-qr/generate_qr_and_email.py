@@ -1,14 +1,18 @@
 # generate_qr_and_email.py
 import os
+import argparse
 import time
 import base64
+import queue
 from io import BytesIO
 import sqlite3
 from email.message import EmailMessage
 import smtplib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pandas as pd
 import qrcode
+from qrcode.image.pil import PilImage
 from cryptography.fernet import Fernet
 from dotenv import load_dotenv
 from PIL import Image
@@ -26,6 +30,10 @@ STUDENTS_CSV = "students.csv"
 OUT_DIR = "qrs"
 DB_FILE = "attendance.db"
 SENDER_NAME = "Hostel Ice Cream Night Team"
+RATE_LIMIT_CODES = {421, 450, 451}  # transient "slow down" replies worth retrying
+MAX_BACKOFF = 30  # seconds; give up on a message once the wait would exceed this
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", 4))  # parallel SMTP sessions; keep within provider limits
+DB_BATCH_SIZE = 50  # sent students are saved in transactions of this many rows
 
 if not EMAIL_ADDRESS or not EMAIL_PASSWORD or not FERNET_KEY:
     raise RuntimeError("Please set EMAIL_ADDRESS, EMAIL_PASSWORD, and ENCRYPTION_KEY in .env or env variables")
@@ -34,8 +42,18 @@ fernet = Fernet(FERNET_KEY)
 os.makedirs(OUT_DIR, exist_ok=True)
 
 # DB helpers
-def init_db():
+def get_conn():
+    # synchronous/temp_store/mmap/cache are per-connection, so set them on every open
     conn = sqlite3.connect(DB_FILE, timeout=30)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=67108864")
+    conn.execute("PRAGMA cache_size=-20000")
+    return conn
+
+def init_db():
+    conn = get_conn()
+    conn.execute("PRAGMA journal_mode=WAL")  # persists in the db file
     cur = conn.cursor()
     cur.execute("""
     CREATE TABLE IF NOT EXISTS students (
@@ -55,18 +73,28 @@ def init_db():
         note TEXT
     )
     """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_students_token ON students(token_b64)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_attendance_roll ON attendance(roll_no)")
     conn.commit()
     conn.close()
 
-def save_student_token_db(roll, name, email, token_b64):
-    conn = sqlite3.connect(DB_FILE, timeout=30)
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT OR REPLACE INTO students (roll_no, name, email, token_b64, created_at)
-        VALUES (?, ?, ?, ?, datetime('now'))
-    """, (roll, name, email, token_b64))
-    conn.commit()
-    conn.close()
+def save_student_tokens_db(rows):
+    # rows: list of (roll, name, email, token_b64); one transaction for the whole batch
+    if not rows:
+        return
+    conn = get_conn()
+    try:
+        conn.execute("BEGIN")
+        conn.executemany("""
+            INSERT OR REPLACE INTO students (roll_no, name, email, token_b64, created_at)
+            VALUES (?, ?, ?, ?, datetime('now'))
+        """, rows)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
 def make_token(roll_no: str) -> bytes:
     nonce = base64.urlsafe_b64encode(os.urandom(6)).decode("utf-8")
@@ -74,15 +102,33 @@ def make_token(roll_no: str) -> bytes:
     token = fernet.encrypt(payload.encode("utf-8"))
     return token
 
+# QR version needed per token length; Fernet tokens for rolls of the same
+# length are the same size, so the fit search only runs once per length
+_qr_versions = {}
+
 def generate_qr_image_from_token(token: bytes):
     token_b64 = base64.urlsafe_b64encode(token).decode("utf-8")
-    qr = qrcode.QRCode(box_size=8, border=2)
+    version = _qr_versions.get(len(token_b64))
+    qr = qrcode.QRCode(version=version, error_correction=qrcode.constants.ERROR_CORRECT_M,
+                       box_size=8, border=2)
     qr.add_data(token_b64)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
+    qr.make(fit=version is None)
+    _qr_versions[len(token_b64)] = qr.version
+    img = qr.make_image(image_factory=PilImage, fill_color="black", back_color="white")
     return img, token_b64
 
-def send_email_with_attachment(to_email, subject, body, attachment_bytes, attachment_filename):
+def open_smtp():
+    smtp = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
+    smtp.ehlo()
+    if SMTP_PORT == 587:
+        smtp.starttls()
+        smtp.ehlo()
+    smtp.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
+    return smtp
+
+def send_email_with_attachment(smtp, to_email, subject, body, attachment_bytes, attachment_filename):
+    # sends over an already-open session; returns the session to keep using
+    # (a fresh one if the server dropped us and we had to reconnect)
     msg = EmailMessage()
     msg["From"] = f"{SENDER_NAME} <{EMAIL_ADDRESS}>"
     msg["To"] = to_email
@@ -90,54 +136,186 @@ def send_email_with_attachment(to_email, subject, body, attachment_bytes, attach
     msg.set_content(body)
     msg.add_attachment(attachment_bytes, maintype="image", subtype="png", filename=attachment_filename)
 
-    with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as smtp:
-        smtp.ehlo()
-        if SMTP_PORT == 587:
-            smtp.starttls()
-            smtp.ehlo()
-        smtp.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        smtp.send_message(msg)
+    return send_with_backoff(smtp, msg)
 
-def main():
-    init_db()
+def smtp_reply_code(e):
+    # RCPT TO rejections (where providers usually throttle) carry their codes
+    # per recipient; we always send to exactly one
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return next((code for code, _ in e.recipients.values()), None)
+    return e.smtp_code
+
+def send_with_backoff(smtp, msg):
+    # no fixed delay between sends: only slow down when the server says so.
+    # On failure, any session opened here is closed; the caller keeps the
+    # one it passed in (the next send over it reconnects if it is dead).
+    current = smtp
+    back_off = 1
+    reconnected = False
+    try:
+        while True:
+            try:
+                current.send_message(msg)
+                return current
+            except smtplib.SMTPServerDisconnected:
+                # server closed an idle/long-lived session: reconnect and retry once
+                if reconnected:
+                    raise
+                reconnected = True
+                current = open_smtp()
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused) as e:
+                code = smtp_reply_code(e)
+                if code not in RATE_LIMIT_CODES or back_off > MAX_BACKOFF:
+                    raise
+                print(f"[THROTTLED] {msg['To']}: {code}, retrying in {back_off}s")
+                time.sleep(back_off)
+                back_off *= 2
+                close_smtp(current)
+                current = open_smtp()
+    except Exception:
+        if current is not smtp:
+            close_smtp(current)
+        raise
+
+def close_smtp(smtp):
+    try:
+        smtp.quit()
+    except smtplib.SMTPException:
+        smtp.close()
+
+def process_student(name, roll, email, smtp_pool):
+    name = name.strip()
+    roll = roll.strip()
+    email = email.strip()
+
+    token = make_token(roll)
+    img, token_b64 = generate_qr_image_from_token(token)
+
+    # encode the PNG once and reuse the bytes for both the file and the attachment;
+    # compress_level=1 is much faster than the default and barely larger for 1-bit QRs
+    bio = BytesIO()
+    img.save(bio, format="PNG", compress_level=1)
+    png_bytes = bio.getvalue()
+
+    filename = f"{roll}.png"
+    out_path = os.path.join(OUT_DIR, filename)
+    with open(out_path, "wb") as f:
+        f.write(png_bytes)
+
+    # email
+    smtp = smtp_pool.get()
+    try:
+        smtp = send_email_with_attachment(smtp, email,
+                                          "Your QR for Ice Cream Night — verify at the gate!",
+                                          f"Hello {name},\n\nAttached is your unique QR code for Ice Cream Night. Save it on your phone and present it at the gate.\n\n-- {SENDER_NAME}",
+                                          png_bytes, filename)
+    finally:
+        smtp_pool.put(smtp)
+    print(f"[SENT] {roll} -> {email}")
+
+    # only students who were actually emailed count as enrolled, so a failed
+    # send is retried on the next run
+    return (roll, name, email, token_b64)
+
+def flush_student_rows(rows):
+    # saves and clears rows; on a DB error they stay queued for the next flush
+    try:
+        save_student_tokens_db(rows)
+    except sqlite3.Error as e:
+        print(f"[ERROR] Could not save {len(rows)} sent students yet: {e}")
+        return
+    rows.clear()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate QR tokens and email them to students.")
+    parser.add_argument("--force", action="store_true",
+                        help="re-issue and re-send to students already in the DB")
+    parser.add_argument("--only-roll", metavar="ROLL",
+                        help="process just this roll number (add --force to re-issue an enrolled one)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="list who would be emailed without generating, saving or sending anything")
+    return parser.parse_args(argv)
+
+def load_enrolled_rolls():
+    # read-only and tolerant of a missing DB/table, so --dry-run creates nothing
+    if not os.path.exists(DB_FILE):
+        return set()
+    conn = sqlite3.connect(f"file:{DB_FILE}?mode=ro", uri=True, timeout=30)
+    try:
+        return {r for (r,) in conn.execute("SELECT roll_no FROM students")}
+    except sqlite3.OperationalError:
+        return set()
+    finally:
+        conn.close()
+
+def main(argv=None):
+    args = parse_args(argv)
     df = pd.read_csv(STUDENTS_CSV, dtype=str)
     for col in ("name", "roll_no", "email"):
         if col not in df.columns:
             raise RuntimeError(f"students.csv must contain column: {col}")
 
+    if args.only_roll:
+        df = df[df["roll_no"].str.strip() == args.only_roll.strip()]
+    if not args.force:
+        # incremental runs: only students not yet enrolled get a QR + email
+        enrolled = df["roll_no"].str.strip().isin(load_enrolled_rolls())
+        if enrolled.any():
+            print(f"Skipping {enrolled.sum()} already enrolled (use --force to re-send)")
+        df = df[~enrolled]
+
+    if args.dry_run:
+        for roll, email in df[["roll_no", "email"]].itertuples(index=False, name=None):
+            print(f"[DRY-RUN] {str(roll).strip()} -> {str(email).strip()}")
+        print(f"Dry run. Would send: {len(df)}")
+        return
+    if df.empty:
+        print("Nothing to send.")
+        return
+
+    init_db()
+
     sent = 0
     errs = []
+    rows = []  # sent students not yet saved; flushed every DB_BATCH_SIZE
+    futures = {}
+
+    # pool of logged-in SMTP sessions, one per worker
+    workers = max(1, min(SMTP_POOL_SIZE, len(df)))
+    smtp_pool = queue.Queue()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for _ in range(workers):
+            smtp_pool.put(open_smtp())
 
-    for idx, row in df.iterrows():
-        try:
-            name = row["name"].strip()
-            roll = row["roll_no"].strip()
-            email = row["email"].strip()
-
-            token = make_token(roll)
-            img, token_b64 = generate_qr_image_from_token(token)
-
-            filename = f"{roll}.png"
-            out_path = os.path.join(OUT_DIR, filename)
-            img.save(out_path)
-
-            # save token to DB
-            save_student_token_db(roll, name, email, token_b64)
-
-            # email
-            bio = BytesIO()
-            img.save(bio, format="PNG")
-            bio.seek(0)
-            send_email_with_attachment(email,
-                                       "Your QR for Ice Cream Night — verify at the gate!",
-                                       f"Hello {name},\n\nAttached is your unique QR code for Ice Cream Night. Save it on your phone and present it at the gate.\n\n-- {SENDER_NAME}",
-                                       bio.read(), filename)
-            sent += 1
-            print(f"[SENT] {roll} -> {email}")
-            time.sleep(0.6)  # adjust if SMTP throttles
-        except Exception as e:
-            errs.append((row.get("roll_no", ""), row.get("email", ""), str(e)))
-            print(f"[ERROR] Row {idx}: {e}")
+        # plain (idx, name, roll_no, email) tuples; no per-row Series like iterrows()
+        futures = {
+            executor.submit(process_student, name, roll, email, smtp_pool): (idx, roll, email)
+            for idx, name, roll, email in df[["name", "roll_no", "email"]].itertuples(name=None)
+        }
+        for fut in as_completed(futures):
+            idx, roll, email = futures.pop(fut)
+            try:
+                rows.append(fut.result())
+                sent += 1
+            except Exception as e:
+                errs.append((roll, email, str(e)))
+                print(f"[ERROR] Row {idx}: {e}")
+            if len(rows) >= DB_BATCH_SIZE:
+                flush_student_rows(rows)
+    finally:
+        # on Ctrl-C or any error: don't start queued jobs, but wait for the
+        # in-flight ones and still record whoever they emailed
+        executor.shutdown(wait=True, cancel_futures=True)
+        for fut in futures:
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                rows.append(fut.result())
+                sent += 1
+        while not smtp_pool.empty():
+            close_smtp(smtp_pool.get_nowait())
+        flush_student_rows(rows)
+        if rows:
+            print(f"[ERROR] Emailed but NOT saved: {[r[0] for r in rows]}")
 
     print(f"Done. Sent: {sent}. Errors: {len(errs)}")
     if errs:
@@ -3,15 +3,16 @@ import os
 import base64
 import sqlite3
 import time
+import queue
 import threading
+from collections import Counter
 from datetime import datetime
 
 import pandas as pd
 import streamlit as st
 from dotenv import load_dotenv
-from cryptography.fernet import Fernet
-from pyzbar.pyzbar import decode
-from PIL import Image
+from cryptography.hazmat.primitives import hashes, hmac, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 import numpy as np
 import cv2
 import av
@@ -32,12 +33,20 @@ load_dotenv()
 FERNET_KEY = os.getenv("ENCRYPTION_KEY")
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "icecream@iitm")
 DB_FILE = "attendance.db"
+MAX_DECODE_SIDE = 720  # frames larger than this are downscaled before decoding
+OVERLAY_SECONDS = 1.5  # how long a scan result stays drawn on the preview
 
 if not FERNET_KEY:
     st.error("❌ ENCRYPTION_KEY missing in .env file")
     st.stop()
 
-fernet = Fernet(FERNET_KEY)
+try:
+    _fernet_key = base64.urlsafe_b64decode(FERNET_KEY)
+except ValueError:
+    _fernet_key = b""
+if len(_fernet_key) != 32:
+    st.error("❌ ENCRYPTION_KEY must be a Fernet key (32 url-safe base64-encoded bytes)")
+    st.stop()
 
 st.set_page_config(
     page_title="🍦 Ice Cream Night — QR Verification",
@@ -51,11 +60,65 @@ RTC_CONFIGURATION = RTCConfiguration(
     {"iceServers": [{"urls": ["stun:stun.l.google.com:19302"]}]}
 )
 
+# --------------------------------------------------------------------
+# TOKEN DECRYPTION
+# --------------------------------------------------------------------
+# Fernet token = version(1) | timestamp(8) | iv(16) | ciphertext | hmac(32).
+# Keys and the HMAC template are built once; each scan only copies the MAC
+# and runs AES-CBC. The HMAC is still checked (constant time), but not the
+# timestamp -- QRs are issued by us and have no TTL.
+_mac_template = hmac.HMAC(_fernet_key[:16], hashes.SHA256())
+_aes = algorithms.AES(_fernet_key[16:])
+
+def decrypt_token(token_bytes):
+    data = base64.urlsafe_b64decode(token_bytes)
+    if len(data) < 1 + 8 + 16 + 16 + 32:
+        raise ValueError("token too short")
+    mac = _mac_template.copy()
+    mac.update(data[:-32])
+    mac.verify(data[-32:])  # raises InvalidSignature on tampering
+    decryptor = Cipher(_aes, modes.CBC(data[9:25])).decryptor()
+    padded = decryptor.update(data[25:-32]) + decryptor.finalize()
+    unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+    return unpadder.update(padded) + unpadder.finalize()
+
 # --------------------------------------------------------------------
 # DATABASE HELPERS
 # --------------------------------------------------------------------
+def apply_pragmas(conn):
+    # synchronous/temp_store/mmap/cache are per-connection, so set them on every open
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=67108864")
+    conn.execute("PRAGMA cache_size=-20000")
+
+@st.cache_resource
+def _thread_conns():
+    # survives script reruns; each thread lazily opens and keeps its own connection
+    return threading.local()
+
+def get_conn():
+    local = _thread_conns()
+    if not hasattr(local, "conn"):
+        local.conn = sqlite3.connect(DB_FILE, timeout=30)
+        apply_pragmas(local.conn)
+    return local.conn
+
+def drop_conn():
+    # discard this thread's connection (rolling back anything open) so the
+    # next get_conn() reconnects
+    local = _thread_conns()
+    conn = getattr(local, "conn", None)
+    if conn is not None:
+        del local.conn
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
 def init_db():
-    conn = sqlite3.connect(DB_FILE, timeout=30)
+    conn = get_conn()
+    conn.execute("PRAGMA journal_mode=WAL")  # persists in the db file
     cur = conn.cursor()
     cur.execute("""
     CREATE TABLE IF NOT EXISTS students (
@@ -75,65 +138,126 @@ def init_db():
         note TEXT
     )
     """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_students_token ON students(token_b64)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_attendance_roll ON attendance(roll_no)")
     conn.commit()
-    conn.close()
+
+def load_lookup(lookup):
+    # students are written once at enrollment, so keep them (and who is
+    # already marked) in memory instead of querying on every scan
+    conn = get_conn()
+    students = conn.execute("SELECT roll_no, name, email, token_b64 FROM students").fetchall()
+
+    by_roll = {}
+    by_token = {}
+    for roll, name, email, token_b64 in students:
+        student = {"roll_no": roll, "name": name, "email": email}
+        by_roll[roll] = student
+        if token_b64:
+            by_token[token_b64] = student
+    lookup["by_roll"] = by_roll
+    lookup["by_token"] = by_token
+    # marked = what the DB has now plus rows the writer hasn't committed yet.
+    # Read under the writer lock: a roll only leaves "pending" after its commit,
+    # so it is always in one of the two.
+    writer = lookup["writer"]
+    with writer["lock"]:
+        marked = {r for (r,) in conn.execute("SELECT DISTINCT roll_no FROM attendance")}
+        lookup["marked"] = marked | set(writer["pending"])
+
+@st.cache_resource
+def get_lookup(_writer):
+    lookup = {"writer": _writer}
+    load_lookup(lookup)
+    return lookup
 
 def get_student_by_roll(roll):
-    conn = sqlite3.connect(DB_FILE, timeout=30)
-    cur = conn.cursor()
-    cur.execute("SELECT roll_no, name, email FROM students WHERE roll_no = ?", (roll,))
-    row = cur.fetchone()
-    conn.close()
-    if row:
-        return {"roll_no": row[0], "name": row[1], "email": row[2]}
-    return None
+    return lookup["by_roll"].get(roll)
 
 def get_student_by_token_b64(token_b64):
-    conn = sqlite3.connect(DB_FILE, timeout=30)
-    cur = conn.cursor()
-    cur.execute("SELECT roll_no, name, email FROM students WHERE token_b64 = ?", (token_b64,))
-    row = cur.fetchone()
-    conn.close()
-    if row:
-        return {"roll_no": row[0], "name": row[1], "email": row[2]}
-    return None
-
-def attendance_exists(roll):
-    conn = sqlite3.connect(DB_FILE, timeout=30)
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM attendance WHERE roll_no = ? LIMIT 1", (roll,))
-    exists = cur.fetchone() is not None
-    conn.close()
-    return exists
+    return lookup["by_token"].get(token_b64)
+
+@st.cache_data(ttl=5)
+def load_attendance():
+    return pd.read_sql_query("SELECT * FROM attendance ORDER BY timestamp_iso DESC", get_conn())
+
+@st.cache_data(ttl=5)
+def load_students():
+    return pd.read_sql_query("SELECT roll_no, name, email FROM students", get_conn())
+
+@st.cache_data(max_entries=1)
+def attendance_csv(row_count, _df_att):
+    # attendance is append-only, so the row count identifies the export
+    return _df_att.to_csv(index=False).encode("utf-8")
+
+def _attendance_writer(writer):
+    # single writer: drains queued scans and commits them in one transaction.
+    # A failed batch is never dropped: it is retried with back-off on a fresh
+    # connection, and writer["error"] stays set so the gate can show it.
+    q = writer["queue"]
+    while True:
+        batch = [q.get()]
+        while len(batch) < 50:
+            try:
+                batch.append(q.get_nowait())
+            except queue.Empty:
+                break
+        back_off = 0.1
+        while True:
+            try:
+                conn = get_conn()
+                conn.execute("BEGIN")
+                conn.executemany(
+                    "INSERT INTO attendance (roll_no, timestamp_iso, source, note) VALUES (?, ?, ?, ?)",
+                    batch,
+                )
+                conn.commit()
+                with writer["lock"]:
+                    writer["pending"].subtract(roll for roll, *_ in batch)
+                    writer["pending"] += Counter()  # drop zero counts
+                break
+            except sqlite3.Error as e:
+                writer["error"] = str(e)
+                print(f"[ERROR] Attendance write failed, {len(batch)} rows pending: {e}")
+                drop_conn()
+                time.sleep(back_off)
+                back_off = min(back_off * 2, 5)
+        writer["error"] = None
+
+@st.cache_resource
+def get_attendance_writer():
+    # one queue + writer thread per server process, not per script rerun
+    # pending counts rolls queued or in flight but not yet committed
+    writer = {"queue": queue.Queue(), "error": None, "lock": threading.Lock(), "pending": Counter()}
+    threading.Thread(target=_attendance_writer, args=(writer,), daemon=True).start()
+    return writer
 
 def add_attendance(roll, source="webrtc_scan", note=""):
-    tries = 0
-    while True:
-        try:
-            conn = sqlite3.connect(DB_FILE, timeout=30)
-            cur = conn.cursor()
-            ts = datetime.utcnow().isoformat(timespec="seconds") + "Z"
-            cur.execute(
-                "INSERT INTO attendance (roll_no, timestamp_iso, source, note) VALUES (?, ?, ?, ?)",
-                (roll, ts, source, note),
-            )
-            conn.commit()
-            conn.close()
-            return ts
-        except sqlite3.OperationalError as e:
-            tries += 1
-            if tries > 8:
-                raise
-            time.sleep(0.1)
+    # check-and-mark in memory under one lock so two scans of the same roll
+    # (e.g. two cameras) can't both get in; returns None if already marked
+    with attendance_writer["lock"]:
+        if roll in lookup["marked"]:
+            return None
+        lookup["marked"].add(roll)
+        attendance_writer["pending"][roll] += 1
+    ts = datetime.utcnow().isoformat(timespec="seconds") + "Z"
+    attendance_writer["queue"].put((roll, ts, source, note))
+    return ts
 
 # --------------------------------------------------------------------
 # INITIAL SETUP
 # --------------------------------------------------------------------
 init_db()
-conn = sqlite3.connect(DB_FILE, timeout=30)
-students_count = conn.execute("SELECT COUNT(*) FROM students").fetchone()[0]
-conn.close()
-st.sidebar.markdown(f"**Students loaded:** {students_count}")
+attendance_writer = get_attendance_writer()
+lookup = get_lookup(attendance_writer)
+if st.sidebar.button("🔄 Reload students"):
+    load_lookup(lookup)
+st.sidebar.markdown(f"**Students loaded:** {len(lookup['by_roll'])}")
+if attendance_writer["error"]:
+    st.sidebar.error(
+        f"❌ Attendance not saving: {attendance_writer['error']} "
+        f"({attendance_writer['queue'].qsize()} scans waiting)"
+    )
 
 mode = st.sidebar.radio("Mode", ["Live Scan", "Admin / Logs"])
 
@@ -157,71 +281,142 @@ if mode == "Live Scan":
         def __init__(self):
             self.last_seen = {}
             self.last_color = (255, 255, 255)
+            # recv only hands the newest frame to the decode thread (older ones
+            # are dropped) and draws whatever overlay that thread produced last
+            self.latest_frame = None
+            self.frame_evt = threading.Event()
+            self.overlay_lock = threading.Lock()
+            self.overlays = []
+            self.overlay_until = 0.0
+            self.running = True
+            # decode-thread state, reused across frames: one detector and
+            # grayscale/downscale buffers sized on the first frame
+            self.detector = cv2.QRCodeDetector()
+            self.gray_buf = None
+            self.small_buf = None
+            self.scale = 1.0
+            threading.Thread(target=self._decode_loop, daemon=True).start()
 
         def recv(self, frame):
             img = frame.to_ndarray(format="bgr24")
-            pil = Image.fromarray(img[:, :, ::-1])  # BGR → RGB
-            decoded = decode(pil)
-
-            color = (255, 255, 255)  # default white
-            text_overlay = None
-
-            if decoded:
-                for d in decoded:
-                    try:
-                        qr_data = d.data.decode("utf-8")
-                    except Exception:
-                        continue
-                    now = time.time()
-                    if qr_data in self.last_seen and now - self.last_seen[qr_data] < 3:
-                        continue
-                    self.last_seen[qr_data] = now
-
+            self.latest_frame = img
+            self.frame_evt.set()
+            return av.VideoFrame.from_ndarray(self._draw_overlay(img.copy()), format="bgr24")
+
+        def on_ended(self):
+            self.running = False
+            self.frame_evt.set()
+
+        def _decode_loop(self):
+            while self.running:
+                if not self.frame_evt.wait(timeout=0.5):
+                    continue
+                self.frame_evt.clear()
+                img = self.latest_frame
+                if img is None:
+                    continue
+                try:
+                    overlays = self._decode(img)
+                except Exception as e:
+                    print(f"[ERROR] QR decode failed: {e}")
+                    continue
+                if overlays:
+                    with self.overlay_lock:
+                        self.overlays = overlays
+                        self.overlay_until = time.time() + OVERLAY_SECONDS
+
+        def _draw_overlay(self, img):
+            with self.overlay_lock:
+                overlays = self.overlays if time.time() < self.overlay_until else []
+            for (x, y, w, h), text_overlay, color in overlays:
+                cv2.rectangle(img, (x, y), (x + w, y + h), color, 4)
+                if text_overlay:
+                    cv2.putText(
+                        img,
+                        text_overlay,
+                        (x, y - 10),
+                        cv2.FONT_HERSHEY_SIMPLEX,
+                        0.8,
+                        color,
+                        2,
+                        cv2.LINE_AA,
+                    )
+            return img
+
+        def _ensure_buffers(self, shape):
+            if self.gray_buf is not None and self.gray_buf.shape == shape:
+                return
+            h, w = shape
+            self.gray_buf = np.empty((h, w), np.uint8)
+            self.small_buf = None
+            self.scale = 1.0
+            if max(h, w) > MAX_DECODE_SIDE:
+                self.scale = MAX_DECODE_SIDE / max(h, w)
+                self.small_buf = np.empty(
+                    (max(1, round(h * self.scale)), max(1, round(w * self.scale))), np.uint8
+                )
+
+        def _decode(self, img):
+            self._ensure_buffers(img.shape[:2])
+            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=self.gray_buf)
+            scale = self.scale
+            if self.small_buf is not None:
+                small_h, small_w = self.small_buf.shape
+                gray = cv2.resize(gray, (small_w, small_h), dst=self.small_buf,
+                                  interpolation=cv2.INTER_AREA)
+            ok, datas, points, _ = self.detector.detectAndDecodeMulti(gray)
+            if not ok:
+                return []
+
+            overlays = []
+            for qr_data, pts in zip(datas, points):
+                if not qr_data:
+                    continue  # located but not decodable in this frame
+                now = time.time()
+                if qr_data in self.last_seen and now - self.last_seen[qr_data] < 3:
+                    continue
+                self.last_seen[qr_data] = now
+
+                # an issued token is its own proof: only decrypt when it isn't on file
+                student = get_student_by_token_b64(qr_data)
+                if student:
+                    roll_no = student["roll_no"]
+                else:
                     try:
                         token_bytes = base64.urlsafe_b64decode(qr_data)
-                        payload = fernet.decrypt(token_bytes).decode("utf-8")
+                        payload = decrypt_token(token_bytes).decode("utf-8")
                         roll_no, nonce = payload.split("|")
                         roll_no = roll_no.strip()
                     except Exception:
                         safe_toast("❌ Invalid or tampered QR", "red")
-                        color = (0, 0, 255)
-                        text_overlay = "Invalid QR"
                         continue
 
                     student = get_student_by_roll(roll_no)
                     if not student:
-                        student = get_student_by_token_b64(qr_data)
-                        if not student:
-                            safe_toast("⚠️ Unknown student", "orange")
-                            color = (0, 165, 255)
-                            text_overlay = "Unknown QR"
-                            continue
-
-                    if attendance_exists(roll_no):
-                        safe_toast(f"⚠️ {roll_no} already marked", "orange")
-                        color = (0, 165, 255)
-                        text_overlay = f"{roll_no} already marked"
-                    else:
-                        ts = add_attendance(roll_no, source="webrtc_live")
-                        safe_toast(f"✅ Verified: {student['name']} ({roll_no})", "green")
-                        color = (0, 255, 0)
-                        text_overlay = f"{student['name']} ✓"
-
-                    (x, y, w, h) = d.rect
-                    cv2.rectangle(img, (x, y), (x + w, y + h), color, 4)
-                    if text_overlay:
-                        cv2.putText(
-                            img,
-                            text_overlay,
-                            (x, y - 10),
-                            cv2.FONT_HERSHEY_SIMPLEX,
-                            0.8,
-                            color,
-                            2,
-                            cv2.LINE_AA,
-                        )
-
-            return av.VideoFrame.from_ndarray(img, format="bgr24")
+                        safe_toast("⚠️ Unknown student", "orange")
+                        continue
+
+                ts = add_attendance(roll_no, source="webrtc_live")
+                if ts is None:
+                    safe_toast(f"⚠️ {roll_no} already marked", "orange")
+                    color = (0, 165, 255)
+                    text_overlay = f"{roll_no} already marked"
+                elif attendance_writer["error"]:
+                    # verified and queued, but the DB is currently rejecting writes
+                    safe_toast(f"⚠️ {roll_no} verified but not saved yet (DB error)", "orange")
+                    color = (0, 165, 255)
+                    text_overlay = f"{student['name']} ✓ (unsaved)"
+                else:
+                    safe_toast(f"✅ Verified: {student['name']} ({roll_no})", "green")
+                    color = (0, 255, 0)
+                    text_overlay = f"{student['name']} ✓"
+
+                # corners are in decode coordinates; map back onto the full frame
+                x0, y0 = pts.min(axis=0) / scale
+                x1, y1 = pts.max(axis=0) / scale
+                rect = (int(x0), int(y0), int(x1 - x0), int(y1 - y0))
+                overlays.append((rect, text_overlay, color))
+            return overlays
 
     webrtc_streamer(
         key="qr-live",
@@ -252,14 +447,17 @@ elif mode == "Admin / Logs":
         st.error("Invalid password.")
         st.stop()
 
-    conn = sqlite3.connect(DB_FILE, timeout=30)
-    df_att = pd.read_sql_query(
-        "SELECT * FROM attendance ORDER BY timestamp_iso DESC", conn
-    )
-    df_students = pd.read_sql_query(
-        "SELECT roll_no, name, email FROM students", conn
-    )
-    conn.close()
+    @st.cache_data(max_entries=1)
+    def search_keys(df):
+        # lower-cased "roll name" per row, built once per table instead of per keystroke
+        return (
+            df["roll_no"].astype(str).str.lower()
+            + " "
+            + df["name"].fillna("").astype(str).str.lower()
+        )
+
+    df_att = load_attendance()
+    df_students = load_students()
 
     st.write(f"**Total verified:** {len(df_att)} students")
 
@@ -271,22 +469,13 @@ elif mode == "Admin / Logs":
             q = st.text_input("Search roll or name")
             if q:
                 qlow = q.lower()
-                filt = df_show[
-                    df_show.apply(
-                        lambda r: qlow
-                        in (
-                            str(r["roll_no"]).lower()
-                            + " "
-                            + str(r.get("name", "") or "").lower()
-                        ),
-                        axis=1,
-                    )
-                ]
+                mask = search_keys(df_show).str.contains(qlow, regex=False)
+                filt = df_show[mask]
                 st.write(f"Matches: {len(filt)}")
                 st.dataframe(filt)
 
     if st.button("📥 Export attendance CSV"):
-        csv_bytes = df_att.to_csv(index=False).encode("utf-8")
+        csv_bytes = attendance_csv(len(df_att), df_att)
         st.download_button(
             "Download CSV", data=csv_bytes, file_name="attendance_log.csv", mime="text/csv"
         )
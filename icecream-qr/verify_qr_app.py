@@ -3,6 +3,7 @@ import os
 import base64
 import sqlite3
 import time
+import threading
 from datetime import datetime
 
 import pandas as pd
@@ -35,8 +36,28 @@ RTC_CONFIGURATION = RTCConfiguration(
 )
 
 # DB helpers
+def apply_pragmas(conn):
+    # synchronous/temp_store/mmap/cache are per-connection, so set them on every open
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=67108864")
+    conn.execute("PRAGMA cache_size=-20000")
+
+@st.cache_resource
+def _thread_conns():
+    # survives script reruns; each thread lazily opens and keeps its own connection
+    return threading.local()
+
+def get_conn():
+    local = _thread_conns()
+    if not hasattr(local, "conn"):
+        local.conn = sqlite3.connect(DB_FILE, timeout=30)
+        apply_pragmas(local.conn)
+    return local.conn
+
 def init_db():
-    conn = sqlite3.connect(DB_FILE, timeout=30)
+    conn = get_conn()
+    conn.execute("PRAGMA journal_mode=WAL")  # persists in the db file
     cur = conn.cursor()
     cur.execute("""
     CREATE TABLE IF NOT EXISTS students (
@@ -56,51 +77,64 @@ def init_db():
         note TEXT
     )
     """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_students_token ON students(token_b64)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_attendance_roll ON attendance(roll_no)")
     conn.commit()
-    conn.close()
 
 def get_student_by_roll(roll):
-    conn = sqlite3.connect(DB_FILE, timeout=30)
+    conn = get_conn()
     cur = conn.cursor()
     cur.execute("SELECT roll_no, name, email FROM students WHERE roll_no = ?", (roll,))
     row = cur.fetchone()
-    conn.close()
     if row:
         return {"roll_no": row[0], "name": row[1], "email": row[2]}
     return None
 
 def get_student_by_token_b64(token_b64):
-    conn = sqlite3.connect(DB_FILE, timeout=30)
+    conn = get_conn()
     cur = conn.cursor()
     cur.execute("SELECT roll_no, name, email FROM students WHERE token_b64 = ?", (token_b64,))
     row = cur.fetchone()
-    conn.close()
     if row:
         return {"roll_no": row[0], "name": row[1], "email": row[2]}
     return None
 
 def attendance_exists(roll):
-    conn = sqlite3.connect(DB_FILE, timeout=30)
+    conn = get_conn()
     cur = conn.cursor()
     cur.execute("SELECT 1 FROM attendance WHERE roll_no = ? LIMIT 1", (roll,))
     exists = cur.fetchone() is not None
-    conn.close()
     return exists
 
+@st.cache_data(ttl=5)
+def load_attendance():
+    return pd.read_sql_query("SELECT * FROM attendance ORDER BY timestamp_iso DESC", get_conn())
+
+@st.cache_data(ttl=5)
+def load_students():
+    return pd.read_sql_query("SELECT roll_no, name, email FROM students", get_conn())
+
+@st.cache_data(max_entries=1)
+def attendance_csv(row_count, _df_att):
+    # attendance is append-only, so the row count identifies the export
+    return _df_att.to_csv(index=False).encode("utf-8")
+
 def add_attendance(roll, source="webrtc_scan", note=""):
     # simple retry loop for sqlite busy
     tries = 0
     while True:
+        conn = None
         try:
-            conn = sqlite3.connect(DB_FILE, timeout=30)
+            conn = get_conn()
             cur = conn.cursor()
             ts = datetime.utcnow().isoformat(timespec="seconds") + "Z"
             cur.execute("INSERT INTO attendance (roll_no, timestamp_iso, source, note) VALUES (?, ?, ?, ?)",
                         (roll, ts, source, note))
             conn.commit()
-            conn.close()
             return ts
         except sqlite3.OperationalError as e:
+            if conn is not None and conn.in_transaction:
+                conn.rollback()
             tries += 1
             if tries > 5:
                 raise
@@ -110,9 +144,8 @@ def add_attendance(roll, source="webrtc_scan", note=""):
 init_db()
 
 # Load students count
-conn = sqlite3.connect(DB_FILE, timeout=30)
+conn = get_conn()
 students_count = conn.execute("SELECT COUNT(*) FROM students").fetchone()[0]
-conn.close()
 st.sidebar.markdown(f"Students in DB: **{students_count}**")
 
 mode = st.sidebar.radio("Mode", ["Live Scan", "Admin / Logs"])
@@ -201,10 +234,14 @@ if mode == "Live Scan":
 
 elif mode == "Admin / Logs":
     st.header("Admin Dashboard: View & Export Logs")
-    conn = sqlite3.connect(DB_FILE, timeout=30)
-    df_att = pd.read_sql_query("SELECT * FROM attendance ORDER BY timestamp_iso DESC", conn)
-    df_students = pd.read_sql_query("SELECT roll_no, name, email FROM students", conn)
-    conn.close()
+
+    @st.cache_data(max_entries=1)
+    def search_keys(df):
+        # lower-cased "roll name" per row, built once per table instead of per keystroke
+        return df["roll_no"].astype(str).str.lower() + " " + df["name"].fillna("").astype(str).str.lower()
+
+    df_att = load_attendance()
+    df_students = load_students()
 
     st.write(f"Total verified: **{len(df_att)}**")
 
@@ -217,12 +254,12 @@ elif mode == "Admin / Logs":
         q = st.text_input("Search roll or name (substring)")
         if q:
             qlow = q.lower()
-            filt = df_show[df_show.apply(lambda r: qlow in (str(r["roll_no"]).lower() + " " + str(r.get("name","") or "").lower()), axis=1)]
+            filt = df_show[search_keys(df_show).str.contains(qlow, regex=False)]
             st.write(f"Matches: {len(filt)}")
             st.dataframe(filt)
 
     if st.button("Export attendance CSV"):
-        csv_bytes = df_att.to_csv(index=False).encode("utf-8")
+        csv_bytes = attendance_csv(len(df_att), df_att)
         st.download_button("Download CSV", data=csv_bytes, file_name="attendance_log.csv", mime="text/csv")
 
     st.markdown("---")